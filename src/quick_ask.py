@@ -35,7 +35,7 @@ class QuickAskWindow(Adw.ApplicationWindow):
     @Gtk.Template.Callback()
     def save_chat(self, button):
         new_chat = self.get_application().get_main_window().get_chat_list_page().new_chat(self.chat.get_name())
-        for message in list(self.chat.container):
+        for message in self.chat.container:
             SQL.insert_or_update_message(message, new_chat.chat_id)
             for attachment in list(message.attachment_container.container) + list(message.image_attachment_container.container):
                 SQL.insert_or_update_attachment(message, attachment)
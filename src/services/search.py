@@ -5,11 +5,15 @@ Provides global search functionality across all chats and messages.
 
 from dataclasses import dataclass
 from datetime import datetime
+from functools import lru_cache
+from pathlib import Path
 from typing import Optional, List
 import sqlite3
+import threading
 import os
 
 
+@lru_cache(maxsize=1)
 def _get_data_dir():
     """Get the data directory for Alpaca database."""
     try:
@@ -62,6 +66,36 @@ class SearchService:
             self.db_path = db_path
         else:
             self.db_path = os.path.join(_get_data_dir(), "alpaca.db")
+        self._conn = None
+        self._closed = False
+        self._lock = threading.Lock()
+    
+    def _get_connection(self) -> Optional[sqlite3.Connection]:
+        """
+        Get the connection shared by every call on this service, opening it
+        on first use. Callers must hold self._lock while using it.
+
+        Returns:
+            The connection, or None once the service has been closed
+        """
+        if self._closed:
+            return None
+        if self._conn is None:
+            # Search never writes, open read-only so no write locks are taken
+            uri = "{}?mode=ro".format(Path(os.path.abspath(self.db_path)).as_uri())
+            self._conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute("PRAGMA mmap_size=268435456")
+            self._conn.execute("PRAGMA temp_store=MEMORY")
+        return self._conn
+    
+    def close(self):
+        """Close the shared database connection, it won't be opened again."""
+        with self._lock:
+            self._closed = True
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
     
     def search_all_chats(
         self, 
@@ -88,9 +122,6 @@ class SearchService:
         results = []
         
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
             # Build the SQL query with optional date filtering
             sql_query = """
                 SELECT 
@@ -118,37 +149,40 @@ class SearchService:
             # Order by date (most recent first)
             sql_query += " ORDER BY m.date_time DESC"
             
-            cursor.execute(sql_query, params)
-            rows = cursor.fetchall()
-            
-            for row in rows:
-                message_id, content, date_time_str, chat_id, chat_name = row
-                
-                # Parse the datetime
-                try:
-                    timestamp = datetime.strptime(date_time_str, "%Y/%m/%d %H:%M:%S")
-                except ValueError:
-                    # Fallback if datetime format is different
-                    timestamp = datetime.now()
+            # Rows are consumed straight from the cursor, the connection is
+            # shared so the lock is held until the last one is read
+            with self._lock:
+                conn = self._get_connection()
+                if conn is None:
+                    return []
+                rows = conn.execute(sql_query, params)
                 
-                # Generate preview with context around the match
-                preview = self.get_search_result_preview(
-                    message_content=content, query=query, context_chars=context_chars
-                )
-                
-                # Calculate relevance score (simple implementation)
-                relevance_score = self._calculate_relevance(content, query)
-                
-                results.append(SearchResult(
-                    chat_id=chat_id,
-                    chat_name=chat_name,
-                    message_id=message_id,
-                    message_preview=preview,
-                    timestamp=timestamp,
-                    relevance_score=relevance_score
-                ))
-            
-            conn.close()
+                for row in rows:
+                    content = row["content"]
+                    
+                    # Parse the datetime
+                    try:
+                        timestamp = datetime.fromisoformat(row["date_time"].replace("/", "-"))
+                    except ValueError:
+                        # Fallback if datetime format is different
+                        timestamp = datetime.now()
+                    
+                    # Generate preview with context around the match
+                    preview = self.get_search_result_preview(
+                        message_content=content, query=query, context_chars=context_chars
+                    )
+                    
+                    # Calculate relevance score (simple implementation)
+                    relevance_score = self._calculate_relevance(content, query)
+                    
+                    results.append(SearchResult(
+                        chat_id=row["chat_id"],
+                        chat_name=row["chat_name"],
+                        message_id=row["message_id"],
+                        message_preview=preview,
+                        timestamp=timestamp,
+                        relevance_score=relevance_score
+                    ))
             
         except sqlite3.Error as e:
             print(f"Database error during search: {e}")
@@ -185,14 +219,16 @@ class SearchService:
         # If message_id provided, fetch content from database
         if message_id is not None:
             try:
-                conn = sqlite3.connect(self.db_path)
-                cursor = conn.cursor()
-                cursor.execute("SELECT content FROM message WHERE id=?", (message_id,))
-                row = cursor.fetchone()
-                conn.close()
+                with self._lock:
+                    conn = self._get_connection()
+                    if conn is None:
+                        return ""
+                    row = conn.execute(
+                        "SELECT content FROM message WHERE id=?", (message_id,)
+                    ).fetchone()
                 
                 if row:
-                    message_content = row[0]
+                    message_content = row["content"]
                 else:
                     return ""
             except sqlite3.Error as e:
@@ -5,10 +5,15 @@ for storing chats, instances, preferences and more.
 
 # sql_manager.py
 
-from typing import Union
+from typing import Union, Iterator
+from functools import lru_cache
+from collections import OrderedDict
 import sqlite3
+import threading
+import atexit
 import uuid
 import datetime
+import time
 import os
 import shutil
 import json
@@ -18,9 +23,39 @@ from . import widgets as Widgets
 from .constants import data_dir
 from gi.repository import Gio, GLib
 
+# Statements that load a chat's messages and attachments, kept as constants so
+# every call hits the connection's statement cache with the same text
+SQL_GET_MESSAGES = "SELECT id, role, model, date_time, content FROM message WHERE chat_id=? ORDER BY rowid"
+SQL_GET_CHAT_ATTACHMENTS = "SELECT message_id, id, type, name, content FROM attachment WHERE message_id IN (SELECT id FROM message WHERE chat_id=?) ORDER BY rowid"
+
+# Statements run while a response is being streamed and saved
+SQL_UPSERT_MESSAGE = "INSERT INTO message (id, chat_id, role, model, date_time, content) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET chat_id=excluded.chat_id, role=excluded.role, model=excluded.model, date_time=excluded.date_time, content=excluded.content"
+SQL_UPDATE_ATTACHMENT = "UPDATE attachment SET message_id=?, type=?, name=?, content=? WHERE id=?"
+SQL_INSERT_ATTACHMENT = "INSERT INTO attachment (id, message_id, type, name, content) VALUES (?, ?, ?, ?, ?)"
+
+ROLES = ("user", "assistant", "system")
+
+# Deprecated preferences table, values are stored as text next to the repr of their type
+PREFERENCE_TYPES = {
+    "<class 'int'>": int,
+    "<class 'float'>": float,
+    "<class 'bool'>": lambda x: x == "1",
+}
+
+# Bump when initialize() gets a new migration
+SCHEMA_VERSION = 1
+
+USE_24H = os.getenv('ALPACA_USE_24H', '0') == '1'
+LOCAL_TIMEZONE = GLib.TimeZone.new_local()
+
+@lru_cache(maxsize=1)
+def get_today(second:int) -> datetime.date:
+    # Keyed by the current second so a list redraw resolves today only once
+    return datetime.date.today()
+
 def format_datetime(dt:datetime.datetime) -> str:
     date = GLib.DateTime.new(
-        GLib.DateTime.new_now_local().get_timezone(),
+        LOCAL_TIMEZONE,
         dt.year,
         dt.month,
         dt.day,
@@ -28,29 +63,17 @@ def format_datetime(dt:datetime.datetime) -> str:
         dt.minute,
         dt.second
     )
-    current_date = GLib.DateTime.new_now_local()
-    if date.format("%Y/%m/%d") == current_date.format("%Y/%m/%d"):
-        if os.getenv('ALPACA_USE_24H', '0') == '1':
-            return date.format("%H:%M")
-        else:
-            return date.format("%I:%M %p")
-    if date.format("%Y") == current_date.format("%Y"):
-        if os.getenv('ALPACA_USE_24H', '0') == '1':
-            return date.format("%b %d, %H:%M")
-        else:
-            return date.format("%b %d, %H:%M")
-    if os.getenv('ALPACA_USE_24H', '0') == '1':
-        return date.format("%b %d %Y, %H:%M")
-    else:
-        return date.format("%b %d %Y, %H:%M")
+    today = get_today(int(time.time()))
+    if dt.date() == today:
+        return date.format("%H:%M" if USE_24H else "%I:%M %p")
+    if dt.year == today.year:
+        return date.format("%b %d, %H:%M")
+    return date.format("%b %d %Y, %H:%M")
 
 def nanoseconds_to_timestamp(ns:int) -> str or None:
     if ns:
-        total_seconds = ns / 1_000_000_000
-
-        hours = int(total_seconds // 3600)
-        minutes = int((total_seconds % 3600) // 60)
-        seconds = int(total_seconds % 60)
+        hours, remainder = divmod(int(ns) // 1_000_000_000, 3600)
+        minutes, seconds = divmod(remainder, 60)
 
         if hours > 0:
             return f'{hours:02}:{minutes:02}:{seconds:02}'
@@ -67,19 +90,23 @@ def dict_to_metadata_string(data:dict) -> str:
     if data.get('prompt_eval_count') and data.get('prompt_eval_duration'):
         metadata_parameters[_('Prompt Eval Count')] =  _('{} tokens').format(data.get('prompt_eval_count'))
         metadata_parameters[_('Prompt Eval Duration')] = nanoseconds_to_timestamp(data.get('prompt_eval_duration'))
-        prompt_eval_rate = data.get('prompt_eval_count') / (data.get('prompt_eval_duration') / (10**9))
+        prompt_eval_rate = data.get('prompt_eval_count') * 1_000_000_000 / data.get('prompt_eval_duration')
         metadata_parameters[_('Prompt Eval Rate')] = _('{} tokens/s').format(round(prompt_eval_rate, 2))
     if data.get('eval_count') and data.get('eval_duration'):
         metadata_parameters[_('Eval Count')] = _('{} tokens').format(data.get('eval_count'))
         metadata_parameters[_('Eval Duration')] = nanoseconds_to_timestamp(data.get('eval_duration'))
-        eval_rate = data.get('eval_count') / (data.get('eval_duration') / (10**9))
+        eval_rate = data.get('eval_count') * 1_000_000_000 / data.get('eval_duration')
         metadata_parameters[_('Eval Rate')] = _('{} tokens/s').format(round(eval_rate, 2))
     metadata_result = ['| {} | {} |'.format(_('Metric'), _('Value')), '| ---- | ---- |']
     metadata_result += ['| {} | {} |'.format(k, vl) for k, vl in metadata_parameters.items() if vl]
     return '\n'.join(metadata_result)
 
+def dump_json(data) -> str:
+    # JSON columns are only read back by json.loads, no need for padding
+    return json.dumps(data, separators=(',', ':'), ensure_ascii=False)
+
 def generate_uuid() -> str:
-    return f"{datetime.datetime.today().strftime('%Y%m%d%H%M%S%f')}{uuid.uuid4().hex}"
+    return uuid.uuid4().hex
 
 def generate_numbered_name(name: str, compare_list: "list[str]") -> str:
     """
@@ -89,20 +116,16 @@ def generate_numbered_name(name: str, compare_list: "list[str]") -> str:
     """
 
     if name in compare_list:
+        compare_set = set(compare_list)
+        stem, dot, extension = name.rpartition(".")
+        if not dot:
+            stem, extension = name, ""
         for i in range(1, len(compare_list) + 1):
-            if "." in name:
-                if (
-                    f"{'.'.join(name.split('.')[:-1])} {i}.{name.split('.')[-1]}"
-                    not in compare_list
-                ):
-                    name = f"{'.'.join(name.split('.')[:-1])} {i}.{name.split('.')[-1]}"
-                    break
-            else:
-                if f"{name} {i}" not in compare_list:
-                    name = f"{name} {i}"
-                    break
+            if f"{stem} {i}{dot}{extension}" not in compare_set:
+                return f"{stem} {i}{dot}{extension}"
     return name
 
+@lru_cache(maxsize=512)
 def prettify_model_name(name:str, separated:bool=False) -> str or tuple:
     if name:
         if ':' in name:
@@ -119,6 +142,41 @@ def prettify_model_name(name:str, separated:bool=False) -> str or tuple:
             else:
                 return name.replace('-', ' ').title()
 
+class RowCache:
+    """
+    A small LRU cache for rows read from the database, it's cleared as a whole
+    whenever anything is written.
+    """
+
+    def __init__(self, max_size:int):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries.get(key)
+
+    def set(self, key, value, generation:int) -> None:
+        with self.lock:
+            if generation != self.generation: # Rows were read before a write
+                return
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+# Message rows of the last chats that were loaded
+row_cache = RowCache(8)
+
 class SQLiteConnection:
     """
     This class manages the context for SQLite database connections.
@@ -127,28 +185,68 @@ class SQLiteConnection:
     sql_path: str = os.path.join(data_dir, "alpaca.db")
     sqlite_con: "Union[sqlite3.Connection, None]" = None
     cursor: "Union[sqlite3.Cursor, None]" = None
+    local: threading.local = threading.local()
 
     def __enter__(self):
         """
-        What happens when the context is entered - in this case, establish a
-        connection to the database.
+        What happens when the context is entered - in this case, get the
+        connection of the current thread, opening it the first time.
         """
 
-        self.sqlite_con = sqlite3.connect(self.sql_path)
+        if getattr(self.local, "sqlite_con", None) is None:
+            self.local.sqlite_con = sqlite3.connect(self.sql_path, cached_statements=512, isolation_level=None)
+            # Autocommit, helpers that write more than once call begin()
+            self.local.sqlite_con.execute("PRAGMA journal_mode=WAL")
+            self.local.sqlite_con.execute("PRAGMA synchronous=NORMAL")
+            self.local.sqlite_con.execute("PRAGMA temp_store=MEMORY")
+            self.local.sqlite_con.execute("PRAGMA cache_size=-20000")
+            self.local.sqlite_con.execute("PRAGMA mmap_size=268435456")
+            self.local.depth = 0
+
+        if self.local.depth == 0:
+            self.local.total_changes = self.local.sqlite_con.total_changes
+        self.local.depth += 1
+        self.sqlite_con = self.local.sqlite_con
         self.cursor = self.sqlite_con.cursor()
 
         return self
 
     def __exit__(self, exception_type, exception_val, traceback) -> None:
         """
-        What to do once the context is exited again: commit and close the
-        connection.
+        What to do once the context is exited again: commit once the
+        outermost context is done (or roll back if it failed) and drop cached
+        rows if anything was written, the connection stays open for reuse.
+        """
+
+        self.local.depth -= 1
+
+        if self.local.depth == 0:
+            if self.sqlite_con.in_transaction:
+                if exception_type is None:
+                    self.sqlite_con.commit()
+                else:
+                    self.sqlite_con.rollback()
+            if self.sqlite_con.total_changes != self.local.total_changes:
+                row_cache.clear()
+
+    def begin(self, mode:str="DEFERRED") -> None:
+        """
+        Starts a transaction, unless an outer context already started one.
+        """
+
+        if not self.sqlite_con.in_transaction:
+            self.cursor.execute(f"BEGIN {mode}")
+
+    def close() -> None:
+        """
+        Closes the connection of the current thread.
         """
 
-        if self.sqlite_con.in_transaction:
-            self.sqlite_con.commit()
+        if getattr(SQLiteConnection.local, "sqlite_con", None) is not None:
+            SQLiteConnection.local.sqlite_con.close()
+            SQLiteConnection.local.sqlite_con = None
 
-        self.sqlite_con.close()
+atexit.register(SQLiteConnection.close)
 
 
 class Instance:
@@ -167,7 +265,8 @@ class Instance:
                     "id": "TEXT NOT NULL PRIMARY KEY",
                     "name": "TEXT NOT NULL",
                     "folder": "TEXT",
-                    "is_template": "INTEGER NOT NULL DEFAULT 0"
+                    "is_template": "INTEGER NOT NULL DEFAULT 0",
+                    "last_message_at": "DATETIME" # Kept up to date by triggers
                 },
                 "message": {
                     "id": "TEXT NOT NULL PRIMARY KEY",
@@ -195,11 +294,6 @@ class Instance:
                     "type": "TEXT NOT NULL",
                     "properties": "TEXT NOT NULL" #JSON
                 },
-                "tool_parameters": {
-                    "name": "TEXT NOT NULL PRIMARY KEY",
-                    "variables": "TEXT NOT NULL",
-                    "activated": "INTEGER NOT NULL"
-                },
                 "online_instance_model_list": {
                     "id": "TEXT NOT NULL PRIMARY KEY",
                     "list": "TEXT NOT NULL" #JSON
@@ -212,83 +306,126 @@ class Instance:
                 }
             }
 
+            indexes = {
+                "idx_message_chat_date": "message(chat_id, date_time)",
+                "idx_attachment_message": "attachment(message_id)",
+                "idx_chat_folder_parent": "chat_folder(parent)"
+            }
+
+            # The whole schema goes in a single script and transaction
+            schema = ["BEGIN"]
             for table_name, columns in tables.items():
                 columns_def = ", ".join([f"{col_name} {col_def}" for col_name, col_def in columns.items()])
-                c.cursor.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ({columns_def})")
-
-            c.cursor.execute("PRAGMA table_info(chat)")
-            columns = [col[1] for col in c.cursor.fetchall()]
-            if 'folder' not in columns:
-                c.cursor.execute("ALTER TABLE chat ADD COLUMN folder TEXT")
-            if 'is_template' not in columns:
-                c.cursor.execute("ALTER TABLE chat ADD COLUMN is_template INTEGER NOT NULL DEFAULT 0") # Treated as boolean 0/1
-            if 'type' in columns: # Rebuild chat table (remove type)
-                c.cursor.execute("ALTER TABLE chat RENAME to chat_old")
-                columns_def = ", ".join([f"{col_name} {col_def}" for col_name, col_def in tables.get('chat').items()])
-                c.cursor.execute(f"CREATE TABLE IF NOT EXISTS chat ({columns_def})")
-                c.cursor.execute(f"INSERT INTO chat (id, name) SELECT id, name FROM chat_old")
-                c.cursor.execute(f"DROP TABLE chat_old")
-            # Remove stuff from previous versions (cleaning)
-            try:
-                model_pictures = c.cursor.execute("SELECT id, picture FROM model")
-                for p in model_pictures:
-                    c.cursor.execute("INSERT INTO model_preferences (id, picture) VALUES (?, ?)", (p[0], p[1]))
-                c.cursor.execute("DROP TABLE model")
-            except Exception:
-                pass
-
-            # Move preferences to GLib
-            if c.cursor.execute("SELECT name FROM sqlite_master WHERE type='table' and name='preferences';").fetchall() != []:
-                settings = Gio.Settings(schema_id="com.jeffser.Alpaca")
-                settings_keys = {
-                    'skip_welcome_page': 'skip-welcome',
-                    'selected_instance': 'selected-instance',
-                    'last_notice_seen': 'last-notice-seen',
-                    'selected_chat': 'default-chat',
-                    'zoom': 'zoom',
-                    'run_on_background': 'hide-on-close',
-                    'powersaver_warning': 'powersaver-warning',
-                    'mic_auto_send': 'stt-auto-send',
-                }
-                old_preferences = Instance.get_preferences()
-                for old_key, new_key in settings_keys.items():
-                    old_value = old_preferences.get(old_key)
-                    if old_value:
-                        if isinstance(old_value, bool):
-                            settings.set_boolean(new_key, old_value)
-                        elif isinstance(old_value, int):
-                            settings.set_int(new_key, old_value)
-                        elif isinstance(old_value, str):
-                            settings.set_string(new_key, old_value)
-                c.cursor.execute("DROP TABLE preferences")
-
-            # Move Instances to new table
-            if c.cursor.execute("SELECT name FROM sqlite_master WHERE type='table' and name='instances';").fetchall() != []:
-                for old_ins in Instance.get_instances_DEPRECATED():
-                    properties = {
-                        'name': old_ins.get('name'),
-                        'temperature': old_ins.get('temperature'),
-                        'default_model': old_ins.get('default_model'),
-                        'title_model': old_ins.get('title_model')
+                schema.append(f"CREATE TABLE IF NOT EXISTS {table_name} ({columns_def})")
+            for index_name, index_def in indexes.items():
+                schema.append(f"CREATE INDEX IF NOT EXISTS {index_name} ON {index_def}")
+            schema.append("COMMIT")
+            c.cursor.executescript(";\n".join(schema) + ";")
+
+            # Migrations from older versions are applied all at once and only
+            # once, user_version records that they're done
+            if c.cursor.execute("PRAGMA user_version").fetchone()[0] < SCHEMA_VERSION:
+                c.begin()
+                c.cursor.execute("PRAGMA table_info(chat)")
+                columns = [col[1] for col in c.cursor.fetchall()]
+                if 'folder' not in columns:
+                    c.cursor.execute("ALTER TABLE chat ADD COLUMN folder TEXT")
+                if 'is_template' not in columns:
+                    c.cursor.execute("ALTER TABLE chat ADD COLUMN is_template INTEGER NOT NULL DEFAULT 0") # Treated as boolean 0/1
+                if 'type' in columns: # Rebuild chat table (remove type)
+                    c.cursor.execute("ALTER TABLE chat RENAME to chat_old")
+                    columns_def = ", ".join([f"{col_name} {col_def}" for col_name, col_def in tables.get('chat').items()])
+                    c.cursor.execute(f"CREATE TABLE IF NOT EXISTS chat ({columns_def})")
+                    c.cursor.execute("INSERT INTO chat (id, name) SELECT id, name FROM chat_old")
+                    c.cursor.execute("DROP TABLE chat_old")
+                if 'last_message_at' not in columns or 'type' in columns:
+                    if 'type' not in columns: # The rebuilt table already has it
+                        c.cursor.execute("ALTER TABLE chat ADD COLUMN last_message_at DATETIME")
+                    c.cursor.execute("UPDATE chat SET last_message_at=(SELECT MAX(date_time) FROM message WHERE chat_id=chat.id)")
+
+                existing_tables = {row[0] for row in c.cursor.execute("SELECT name FROM sqlite_master WHERE type='table'").fetchall()}
+
+                # Remove stuff from previous versions (cleaning)
+                if 'model' in existing_tables:
+                    try:
+                        model_pictures = c.cursor.execute("SELECT id, picture FROM model")
+                        for p in model_pictures:
+                            c.cursor.execute("INSERT INTO model_preferences (id, picture) VALUES (?, ?)", (p[0], p[1]))
+                        c.cursor.execute("DROP TABLE model")
+                    except Exception:
+                        pass
+
+                # Move preferences to GLib
+                if 'preferences' in existing_tables:
+                    settings = Gio.Settings(schema_id="com.jeffser.Alpaca")
+                    settings_keys = {
+                        'skip_welcome_page': 'skip-welcome',
+                        'selected_instance': 'selected-instance',
+                        'last_notice_seen': 'last-notice-seen',
+                        'selected_chat': 'default-chat',
+                        'zoom': 'zoom',
+                        'run_on_background': 'hide-on-close',
+                        'powersaver_warning': 'powersaver-warning',
+                        'mic_auto_send': 'stt-auto-send',
                     }
-                    if old_ins.get('max_tokens', -1) != -1:
-                        properties['max_tokens'] = old_ins.get('max_tokens')
-                    if old_ins.get('type') in ('openai:generic', 'ollama:managed', 'ollama') and old_ins.get('url'):
-                        properties['url'] = old_ins.get('url')
-                    if old_ins.get('type') != 'ollama:managed':
-                        properties['api'] = old_ins.get('api')
-                    if old_ins.get('type') not in ('venice', 'deepseek', 'gemini') and old_ins.get('seed'):
-                        properties['seed'] = old_ins.get('seed')
-                    if old_ins.get('type') == 'ollama:managed':
-                        properties['overrides'] = old_ins.get('overrides')
-                        properties['model_directory'] = old_ins.get('model_directory')
-
-                    c.cursor.execute("INSERT INTO instance (id, pinned, type, properties) VALUES (?, ?, ?, ?)", (old_ins.get('id'), old_ins.get('pinned'), old_ins.get('type'), json.dumps(properties)))
-                c.cursor.execute("DROP TABLE instances")
-
-            # Remove tool_parameters table
-            if c.cursor.execute("SELECT name FROM sqlite_master WHERE type='table' and name='tool_parameters';").fetchall() != []:
-                c.cursor.execute("DROP TABLE tool_parameters")
+                    old_preferences = Instance.get_preferences()
+                    for old_key, new_key in settings_keys.items():
+                        old_value = old_preferences.get(old_key)
+                        if old_value:
+                            if isinstance(old_value, bool):
+                                settings.set_boolean(new_key, old_value)
+                            elif isinstance(old_value, int):
+                                settings.set_int(new_key, old_value)
+                            elif isinstance(old_value, str):
+                                settings.set_string(new_key, old_value)
+                    c.cursor.execute("DROP TABLE preferences")
+
+                # Move Instances to new table
+                if 'instances' in existing_tables:
+                    for old_ins in Instance.get_instances_DEPRECATED():
+                        properties = {
+                            'name': old_ins.get('name'),
+                            'temperature': old_ins.get('temperature'),
+                            'default_model': old_ins.get('default_model'),
+                            'title_model': old_ins.get('title_model')
+                        }
+                        if old_ins.get('max_tokens', -1) != -1:
+                            properties['max_tokens'] = old_ins.get('max_tokens')
+                        if old_ins.get('type') in ('openai:generic', 'ollama:managed', 'ollama') and old_ins.get('url'):
+                            properties['url'] = old_ins.get('url')
+                        if old_ins.get('type') != 'ollama:managed':
+                            properties['api'] = old_ins.get('api')
+                        if old_ins.get('type') not in ('venice', 'deepseek', 'gemini') and old_ins.get('seed'):
+                            properties['seed'] = old_ins.get('seed')
+                        if old_ins.get('type') == 'ollama:managed':
+                            properties['overrides'] = old_ins.get('overrides')
+                            properties['model_directory'] = old_ins.get('model_directory')
+
+                        c.cursor.execute("INSERT INTO instance (id, pinned, type, properties) VALUES (?, ?, ?, ?)", (old_ins.get('id'), old_ins.get('pinned'), old_ins.get('type'), dump_json(properties)))
+                    c.cursor.execute("DROP TABLE instances")
+
+                # Remove tool_parameters table
+                if 'tool_parameters' in existing_tables:
+                    c.cursor.execute("DROP TABLE tool_parameters")
+
+                c.cursor.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+
+            # Need the migrated chat columns, so they can't go with the rest of the schema
+            c.cursor.execute("CREATE INDEX IF NOT EXISTS idx_chat_folder_last_message ON chat(folder, last_message_at DESC)")
+            triggers = {
+                "chat_insert_last_message": "AFTER INSERT ON chat BEGIN \
+                    UPDATE chat SET last_message_at=(SELECT MAX(date_time) FROM message WHERE chat_id=NEW.id) WHERE id=NEW.id; END",
+                "message_insert_last_message": "AFTER INSERT ON message BEGIN \
+                    UPDATE chat SET last_message_at=NEW.date_time WHERE id=NEW.chat_id AND (last_message_at IS NULL OR last_message_at < NEW.date_time); END",
+                "message_update_last_message": "AFTER UPDATE OF chat_id, date_time ON message \
+                    WHEN OLD.chat_id IS NOT NEW.chat_id OR OLD.date_time IS NOT NEW.date_time BEGIN \
+                    UPDATE chat SET last_message_at=(SELECT MAX(date_time) FROM message WHERE chat_id=chat.id) WHERE id IN (OLD.chat_id, NEW.chat_id); END",
+                "message_delete_last_message": "AFTER DELETE ON message BEGIN \
+                    UPDATE chat SET last_message_at=(SELECT MAX(date_time) FROM message WHERE chat_id=OLD.chat_id) WHERE id=OLD.chat_id; END"
+            }
+
+            for trigger_name, trigger_def in triggers.items():
+                c.cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {trigger_name} {trigger_def}")
 
 
     ###########
@@ -299,17 +436,13 @@ class Instance:
         with SQLiteConnection() as c:
             if folder_id is None:
                 chats = c.cursor.execute(
-                    "SELECT chat.id, chat.name, chat.is_template, MAX(message.date_time) AS \
-                    latest_message_time FROM chat LEFT JOIN message ON chat.id = message.chat_id \
-                    WHERE chat.folder IS NULL \
-                    GROUP BY chat.id ORDER BY latest_message_time DESC"
+                    "SELECT id, name, is_template, last_message_at FROM chat \
+                    WHERE folder IS NULL ORDER BY last_message_at DESC"
                 ).fetchall()
             else:
                 chats = c.cursor.execute(
-                    "SELECT chat.id, chat.name, chat.is_template, MAX(message.date_time) AS \
-                    latest_message_time FROM chat LEFT JOIN message ON chat.id = message.chat_id \
-                    WHERE chat.folder=? \
-                    GROUP BY chat.id ORDER BY latest_message_time DESC",
+                    "SELECT id, name, is_template, last_message_at FROM chat \
+                    WHERE folder=? ORDER BY last_message_at DESC",
                     (folder_id,)
                 ).fetchall()
 
@@ -318,84 +451,84 @@ class Instance:
     def get_templates() -> list:
         with SQLiteConnection() as c:
             templates = c.cursor.execute(
-                "SELECT chat.id, chat.name, MAX(message.date_time) AS \
-                latest_message_time FROM chat LEFT JOIN message ON chat.id = message.chat_id \
-                WHERE chat.is_template = 1 \
-                GROUP BY chat.id ORDER BY latest_message_time DESC"
+                "SELECT id, name, last_message_at FROM chat \
+                WHERE is_template = 1 ORDER BY last_message_at DESC"
             ).fetchall()
         return templates
 
-    def get_messages(chat) -> list:
+    def get_messages(chat) -> Iterator[tuple]:
+        messages = row_cache.get(('messages', chat.chat_id))
+        if messages is not None:
+            yield from messages
+            return
+
+        generation = row_cache.generation
         with SQLiteConnection() as c:
-            messages = c.cursor.execute(
-                "SELECT id, role, model, date_time, content FROM message WHERE chat_id=?",
+            cursor = c.cursor.execute(
+                SQL_GET_MESSAGES,
                 (chat.chat_id,),
-            ).fetchall()
+            )
 
-        return messages
+        # Rows are read once the context is closed (the connection stays open),
+        # so a caller that stops early can't leave it nested inside a transaction
+        messages = []
+        for message in cursor:
+            messages.append(message)
+            yield message
+        row_cache.set(('messages', chat.chat_id), messages, generation)
 
-    def get_attachments(message) -> list:
+    def get_chat_attachments(chat) -> dict:
+        # Not cached, attachment content can be megabytes of base64
+        attachments = {}
         with SQLiteConnection() as c:
-            attachments = c.cursor.execute(
-                "SELECT id, type, name, content FROM attachment WHERE message_id=?",
-                (message.message_id,),
-            ).fetchall()
+            for attachment in c.cursor.execute(
+                SQL_GET_CHAT_ATTACHMENTS,
+                (chat.chat_id,),
+            ):
+                attachments.setdefault(attachment[0], []).append(attachment[1:])
 
         return attachments
 
     def export_db(chat, export_sql_path: str) -> None:
         with SQLiteConnection() as c:
             c.cursor.execute("ATTACH DATABASE ? AS export", (export_sql_path,))
-            c.cursor.execute(
-                "CREATE TABLE export.chat AS SELECT * FROM chat WHERE id=?",
-                (chat.chat_id,),
-            )
-            c.cursor.execute(
-                "CREATE TABLE export.message AS SELECT * FROM message WHERE chat_id=?",
-                (chat.chat_id,),
-            )
-            c.cursor.execute(
-                "CREATE TABLE export.attachment AS SELECT a.* FROM attachment as a JOIN message m ON a.message_id = m.id WHERE m.chat_id=?",
-                (chat.chat_id,),
-            )
+            try:
+                # The export file is a scratch copy, it's rebuilt if anything fails
+                c.cursor.execute("PRAGMA export.journal_mode=OFF")
+                c.cursor.execute("PRAGMA export.synchronous=OFF")
+                c.cursor.execute(
+                    "CREATE TABLE export.chat AS SELECT id, name, folder, is_template FROM chat WHERE id=?",
+                    (chat.chat_id,),
+                )
+                c.cursor.execute(
+                    "CREATE TABLE export.message AS SELECT * FROM message WHERE chat_id=? ORDER BY rowid",
+                    (chat.chat_id,),
+                )
+                c.cursor.execute(
+                    "CREATE TABLE export.attachment AS SELECT a.* FROM attachment as a JOIN message m ON a.message_id = m.id WHERE m.chat_id=? ORDER BY a.rowid",
+                    (chat.chat_id,),
+                )
+            finally:
+                # The connection is reused, so the file can't stay attached
+                c.cursor.execute("DETACH DATABASE export")
 
     def insert_or_update_chat(chat) -> None:
         with SQLiteConnection() as c:
-            if c.cursor.execute(
-                "SELECT id FROM chat WHERE id=?", (chat.chat_id,)
-            ).fetchone():
-                if chat.folder_id is None:
-                    c.cursor.execute(
-                        "UPDATE chat SET name=?, folder=NULL, is_template=? WHERE id=?",
-                        (chat.get_name(), chat.is_template, chat.chat_id),
-                    )
-                else:
-                    c.cursor.execute(
-                        "UPDATE chat SET name=?, folder=?, is_template=? WHERE id=?",
-                        (chat.get_name(), chat.folder_id, chat.is_template, chat.chat_id),
-                    )
-            else:
-                if chat.folder_id is None:
-                    c.cursor.execute(
-                        "INSERT INTO chat (id, name, folder, is_template) VALUES (?, ?, NULL, 0)",
-                        (chat.chat_id, chat.get_name()),
-                    )
-                else:
-                    c.cursor.execute(
-                        "INSERT INTO chat (id, name, folder, is_template) VALUES (?, ?, ?, 0)",
-                        (chat.chat_id, chat.get_name(), chat.folder_id),
-                    )
+            # New chats always start as non templates
+            c.cursor.execute(
+                "INSERT INTO chat (id, name, folder, is_template) VALUES (?, ?, ?, 0) ON CONFLICT(id) DO UPDATE SET name=excluded.name, folder=excluded.folder, is_template=?",
+                (chat.chat_id, chat.get_name(), chat.folder_id, chat.is_template),
+            )
 
     def delete_chat(chat) -> None:
         with SQLiteConnection() as c:
+            c.begin()
             c.cursor.execute("DELETE FROM chat WHERE id=?", (chat.chat_id,))
 
-            for message in c.cursor.execute(
-                "SELECT id FROM message WHERE chat_id=?", (chat.chat_id,)
-            ).fetchall():
-                c.cursor.execute(
-                    "DELETE FROM attachment WHERE message_id=?", (message[0],)
-                )
+            c.cursor.execute(
+                "DELETE FROM attachment WHERE message_id IN (SELECT id FROM message WHERE chat_id=?)",
+                (chat.chat_id,),
+            )
 
             c.cursor.execute(
                 "DELETE FROM message WHERE chat_id=?", (chat.chat_id,)
@@ -403,6 +536,7 @@ class Instance:
 
     def factory_reset() -> None: # Deletes all chat folders and everything inside
         with SQLiteConnection() as c:
+            c.begin()
             c.cursor.execute("DELETE FROM chat_folder")
             c.cursor.execute("DELETE FROM chat")
             c.cursor.execute("DELETE FROM message")
@@ -410,112 +544,110 @@ class Instance:
 
     def duplicate_chat(old_chat_id:str, new_chat) -> None:
         with SQLiteConnection() as c:
+            # One write transaction for the chat row and all its copies
+            c.begin("IMMEDIATE")
             Instance.insert_or_update_chat(new_chat)
 
-            for message in c.cursor.execute(
-                "SELECT id, role, model, date_time, content FROM message WHERE chat_id=?",
+            # Ids are generated by SQLite so no rows go through Python, the map
+            # links every copied message to its new id for the attachments
+            c.cursor.execute("DROP TABLE IF EXISTS temp.message_map")
+            c.cursor.execute(
+                "CREATE TEMP TABLE message_map AS SELECT id AS old_id, lower(hex(randomblob(16))) AS new_id FROM message WHERE chat_id=? ORDER BY rowid",
                 (old_chat_id,),
-            ).fetchall():
-                new_message_id = generate_uuid()
-
-                c.cursor.execute(
-                    "INSERT INTO message (id, chat_id, role, model, date_time, content) VALUES (?, ?, ?, ?, ?, ?)",
-                    (
-                        new_message_id,
-                        new_chat.chat_id,
-                        message[1],
-                        message[2],
-                        message[3],
-                        message[4],
-                    ),
-                )
-
-                for attachment in c.cursor.execute(
-                    "SELECT type, name, content FROM attachment WHERE message_id=?",
-                    (message[0],),
-                ).fetchall():
-                    c.cursor.execute(
-                        "INSERT INTO attachment (id, message_id, type, name, content) VALUES (?, ?, ?, ?, ?)",
-                        (
-                            generate_uuid(),
-                            new_message_id,
-                            attachment[0],
-                            attachment[1],
-                            attachment[2],
-                        ),
-                    )
+            )
+            c.cursor.execute(
+                "INSERT INTO message (id, chat_id, role, model, date_time, content) SELECT map.new_id, ?, role, model, date_time, content FROM message JOIN temp.message_map map ON message.id = map.old_id ORDER BY message.rowid",
+                (new_chat.chat_id,),
+            )
+            c.cursor.execute(
+                "INSERT INTO attachment (id, message_id, type, name, content) SELECT lower(hex(randomblob(16))), map.new_id, type, name, content FROM attachment JOIN temp.message_map map ON attachment.message_id = map.old_id ORDER BY attachment.rowid"
+            )
+            c.cursor.execute("DROP TABLE temp.message_map")
 
     def import_chat(import_sql_path: str, chat_names: list, folder_id :str=None) -> list:
         with SQLiteConnection() as c:
             c.cursor.execute("ATTACH DATABASE ? AS import", (import_sql_path,))
-            _chat_widgets = []
-
-            # Check repeated chat.name
-            for repeated_chat in c.cursor.execute(
-                "SELECT import.chat.id, import.chat.name FROM import.chat JOIN chat dbchat ON import.chat.name = dbchat.name"
-            ).fetchall():
-                new_name = generate_numbered_name(repeated_chat[1], chat_names)
+            try:
+                c.begin("IMMEDIATE")
+                _chat_widgets = []
 
-                c.cursor.execute(
+                # Check repeated chat.name
+                c.cursor.executemany(
                     "UPDATE import.chat SET name=? WHERE id=?",
-                    (new_name, repeated_chat[0]),
+                    [
+                        (generate_numbered_name(repeated_chat[1], chat_names), repeated_chat[0])
+                        for repeated_chat in c.cursor.execute(
+                            "SELECT import.chat.id, import.chat.name FROM import.chat JOIN chat dbchat ON import.chat.name = dbchat.name"
+                        ).fetchall()
+                    ],
                 )
 
-            # Check repeated chat.id
-            for repeated_chat in c.cursor.execute(
-                "SELECT import.chat.id FROM import.chat JOIN chat dbchat ON import.chat.id = dbchat.id"
-            ).fetchall():
-                new_id = generate_uuid()
-
-                c.cursor.execute(
+                # Check repeated chat.id
+                new_ids = [
+                    (generate_uuid(), repeated_chat[0])
+                    for repeated_chat in c.cursor.execute(
+                        "SELECT import.chat.id FROM import.chat JOIN chat dbchat ON import.chat.id = dbchat.id"
+                    ).fetchall()
+                ]
+                c.cursor.executemany(
                     "UPDATE import.chat SET id=? WHERE id=?",
-                    (new_id, repeated_chat[0]),
+                    new_ids,
                 )
-                c.cursor.execute(
+                c.cursor.executemany(
                     "UPDATE import.message SET chat_id=? WHERE chat_id=?",
-                    (new_id, repeated_chat[0]),
+                    new_ids,
                 )
 
-            # Check repeated message.id
-            for repeated_message in c.cursor.execute(
-                "SELECT import.message.id FROM import.message JOIN message dbmessage ON import.message.id = dbmessage.id"
-            ).fetchall():
-                new_id = generate_uuid()
-
-                c.cursor.execute(
+                # Check repeated message.id
+                new_ids = [
+                    (generate_uuid(), repeated_message[0])
+                    for repeated_message in c.cursor.execute(
+                        "SELECT import.message.id FROM import.message JOIN message dbmessage ON import.message.id = dbmessage.id"
+                    ).fetchall()
+                ]
+                c.cursor.executemany(
                     "UPDATE import.attachment SET message_id=? WHERE message_id=?",
-                    (new_id, repeated_message[0]),
+                    new_ids,
                 )
-                c.cursor.execute(
+                c.cursor.executemany(
                     "UPDATE import.message SET id=? WHERE id=?",
-                    (new_id, repeated_message[0]),
+                    new_ids,
                 )
 
-            # Check repeated attachment.id
-            for repeated_attachment in c.cursor.execute(
-                "SELECT import.attachment.id FROM import.attachment JOIN attachment dbattachment ON import.attachment.id = dbattachment.id"
-            ).fetchall():
-                new_id = generate_uuid()
-
-                c.cursor.execute(
+                # Check repeated attachment.id
+                c.cursor.executemany(
                     "UPDATE import.attachment SET id=? WHERE id=?",
-                    (new_id, repeated_attachment[0]),
+                    [
+                        (generate_uuid(), repeated_attachment[0])
+                        for repeated_attachment in c.cursor.execute(
+                            "SELECT import.attachment.id FROM import.attachment JOIN attachment dbattachment ON import.attachment.id = dbattachment.id"
+                        ).fetchall()
+                    ],
                 )
 
-            # Import
-            for chat in c.cursor.execute("SELECT * FROM import.chat").fetchall():
-                c.cursor.execute("INSERT INTO chat (id, name, folder) VALUES (?, ?, ?)", (chat[0], chat[1], folder_id))
-
-            c.cursor.execute(
-                "INSERT INTO message SELECT * FROM import.message"
-            )
-            c.cursor.execute(
-                "INSERT INTO attachment SELECT * FROM import.attachment"
-            )
+                # Import
+                c.cursor.execute(
+                    "INSERT INTO chat (id, name, folder) SELECT id, name, ? FROM import.chat",
+                    (folder_id,)
+                )
+                c.cursor.execute(
+                    "INSERT INTO message SELECT * FROM import.message"
+                )
+                c.cursor.execute(
+                    "INSERT INTO attachment SELECT * FROM import.attachment"
+                )
 
-            new_chats = c.cursor.execute(
-                "SELECT * FROM import.chat"
-            ).fetchall()
+                new_chats = c.cursor.execute(
+                    "SELECT * FROM import.chat"
+                ).fetchall()
+            except Exception:
+                c.sqlite_con.rollback()
+                raise
+            finally:
+                # The connection is reused, so the file can't stay attached
+                if c.sqlite_con.in_transaction:
+                    c.sqlite_con.commit()
+                c.cursor.execute("DETACH DATABASE import")
 
         return new_chats
 
@@ -524,73 +656,51 @@ class Instance:
     ##############
 
     def insert_or_update_message(message, force_chat_id: str = None) -> None:
-        message_author = ["user", "assistant", "system"][message.mode]
-        chat_element = message.get_ancestor(Widgets.chat.Chat)
+        # Everything is read from the widget before the write starts, the
+        # widget tree is only walked when the chat isn't given
+        values = (
+            message.message_id,
+            force_chat_id or message.get_ancestor(Widgets.chat.Chat).chat_id,
+            ROLES[message.mode],
+            message.get_model() or "",
+            message.dt.strftime("%Y/%m/%d %H:%M:%S"),
+            message.get_content() or "",
+        )
 
         with SQLiteConnection() as c:
-            if c.cursor.execute(
-                "SELECT id FROM message WHERE id=?", (message.message_id,)
-            ).fetchone():
-                c.cursor.execute(
-                    "UPDATE message SET chat_id=?, role=?, model=?, date_time=?, content=? WHERE id=?",
-                    (
-                        (
-                            force_chat_id
-                            if force_chat_id
-                            else chat_element.chat_id
-                        ),
-                        message_author,
-                        message.get_model() or "",
-                        message.dt.strftime("%Y/%m/%d %H:%M:%S"),
-                        message.get_content() or "",
-                        message.message_id,
-                    ),
-                )
-            else:
-                c.cursor.execute(
-                    "INSERT INTO message (id, chat_id, role, model, date_time, content) VALUES (?, ?, ?, ?, ?, ?)",
-                    (
-                        message.message_id,
-                        (
-                            force_chat_id
-                            if force_chat_id
-                            else chat_element.chat_id
-                        ),
-                        message_author,
-                        message.get_model() or "",
-                        message.dt.strftime("%Y/%m/%d %H:%M:%S"),
-                        message.get_content() or "",
-                    ),
-                )
+            c.cursor.execute(SQL_UPSERT_MESSAGE, values)
 
     def delete_message(message) -> None:
+        Instance.delete_messages((message.message_id,))
+
+    def delete_messages(message_ids:list) -> None: # Deletes the messages and their attachments in one transaction
+        params = [(message_id,) for message_id in message_ids]
         with SQLiteConnection() as c:
-            c.cursor.execute(
-                "DELETE FROM message WHERE id=?", (message.message_id,)
+            c.begin()
+            c.cursor.executemany(
+                "DELETE FROM attachment WHERE message_id=?", params
             )
-            c.cursor.execute(
-                "DELETE FROM attachment WHERE message_id=?",
-                (message.message_id,),
+            c.cursor.executemany(
+                "DELETE FROM message WHERE id=?", params
             )
 
     def insert_or_update_attachment(message, attachment) -> None:
         with SQLiteConnection() as c:
-            if c.cursor.execute(
-                "SELECT id FROM attachment WHERE id=?", (attachment.get_name(),)
-            ).fetchone():
-                c.cursor.execute(
-                    "UPDATE attachment SET message_id=?, type=?, name=?, content=? WHERE id=?",
-                    (
-                        message.message_id,
-                        attachment.file_type,
-                        attachment.file_name,
-                        attachment.file_content,
-                        attachment.get_name()
-                    )
+            c.cursor.execute(
+                SQL_UPDATE_ATTACHMENT,
+                (
+                    message.message_id,
+                    attachment.file_type,
+                    attachment.file_name,
+                    attachment.file_content,
+                    attachment.get_name()
                 )
-            else:
+            )
+            # Unsaved attachments don't have an id yet, so this can't be an
+            # UPSERT on attachment.get_name()
+            if c.cursor.rowcount == 0:
                 c.cursor.execute(
-                    "INSERT INTO attachment (id, message_id, type, name, content) VALUES (?, ?, ?, ?, ?)",
+                    SQL_INSERT_ATTACHMENT,
                     (
                         generate_uuid(),
                         message.message_id,
@@ -617,19 +727,9 @@ class Instance:
             ).fetchall()
 
         preferences = {}
-        type_map = {
-            "<class 'int'>": int,
-            "<class 'float'>": float,
-            "<class 'bool'>": lambda x: x == "1",
-        }
-
-        for row in result:
-            value = row[1]
-
-            if row[2] in type_map:
-                value = type_map[row[2]](value)
-
-            preferences[row[0]] = value
+        for preference_id, value, value_type in result:
+            converter = PREFERENCE_TYPES.get(value_type)
+            preferences[preference_id] = converter(value) if converter else value
 
         return preferences
 
@@ -637,48 +737,24 @@ class Instance:
     ## MODEL ##
     ###########
 
-    def insert_or_update_model_picture(model_id: str, picture_content: str) -> None:
-        with SQLiteConnection() as c:
-            if c.cursor.execute(
-                "SELECT id FROM model WHERE id=?", (model_id,)
-            ).fetchone():
-                c.cursor.execute(
-                    "UPDATE model SET picture=? WHERE id=?",
-                    (picture_content, model_id),
-                )
-
-            else:
-                c.cursor.execute(
-                    "INSERT INTO model (id, picture) VALUES (?, ?)",
-                    (model_id, picture_content),
-                )
-
     def remove_model_preferences(model_id: str) -> None:
         with SQLiteConnection() as c:
             c.cursor.execute("DELETE FROM model_preferences WHERE id=?", (model_id,))
 
     def insert_or_update_model_picture(model_id: str, picture_content: str or None) -> None:
         with SQLiteConnection() as c:
-            if c.cursor.execute("SELECT id FROM model_preferences WHERE id=?", (model_id,)).fetchone():
-                c.cursor.execute("UPDATE model_preferences SET picture=? WHERE id=?", (picture_content, model_id))
-            else:
-                c.cursor.execute("INSERT INTO model_preferences (id, picture) VALUES (?, ?)", (model_id, picture_content))
+            c.cursor.execute("INSERT INTO model_preferences (id, picture) VALUES (?, ?) ON CONFLICT(id) DO UPDATE SET picture=excluded.picture", (model_id, picture_content))
 
     def insert_or_update_model_voice(model_id: str, voice_name: str or None) -> None:
         with SQLiteConnection() as c:
-            if c.cursor.execute("SELECT id FROM model_preferences WHERE id=?", (model_id,)).fetchone():
-                c.cursor.execute("UPDATE model_preferences SET voice=? WHERE id=?", (voice_name, model_id))
-            else:
-                c.cursor.execute("INSERT INTO model_preferences (id, voice) VALUES (?, ?)", (model_id, voice_name))
+            c.cursor.execute("INSERT INTO model_preferences (id, voice) VALUES (?, ?) ON CONFLICT(id) DO UPDATE SET voice=excluded.voice", (model_id, voice_name))
 
     def get_model_preferences(model_id: str) -> dict:
         with SQLiteConnection() as c:
+            c.cursor.row_factory = sqlite3.Row
             row = c.cursor.execute("SELECT picture, voice FROM model_preferences WHERE id=?", (model_id,)).fetchone()
             if row:
-                return {
-                    'picture': row[0],
-                    'voice': row[1]
-                }
+                return dict(row)
             else:
                 return {
                     'picture': None,
@@ -708,6 +784,7 @@ class Instance:
         ]
 
         with SQLiteConnection() as c:
+            c.cursor.row_factory = sqlite3.Row
             result = c.cursor.execute(
                 "SELECT {} FROM instances".format(", ".join(columns))
             ).fetchall()
@@ -715,51 +792,36 @@ class Instance:
         instances = []
 
         for row in result:
-            instances.append({})
-
-            for i, column in enumerate(columns):
-                value = row[i]
-
-                if column == "overrides":
-                    try:
-                        value = json.loads(value)
-                    except Exception:
-                        value = {}
-                elif column == "pinned":
-                    value = value == 1
-
-                instances[-1][column] = value
+            instance = dict(row)
+            try:
+                instance["overrides"] = json.loads(row["overrides"])
+            except Exception:
+                instance["overrides"] = {}
+            instance["pinned"] = row["pinned"] == 1
+            instances.append(instance)
 
         return instances
 
     def get_instances() -> list:
         with SQLiteConnection() as c:
-            result = c.cursor.execute("SELECT * FROM instance").fetchall()
-            instances = []
-            for row in result:
-                instances.append({
-                    'id': row[0],
-                    'pinned': row[1] == 1,
-                    'type': row[2],
-                    'properties': json.loads(row[3])
-                })
-            return instances
-        return []
+            c.cursor.row_factory = sqlite3.Row
+            result = c.cursor.execute("SELECT id, pinned, type, properties FROM instance").fetchall()
+        instances = []
+        for row in result:
+            instance = dict(row)
+            instance['pinned'] = row['pinned'] == 1
+            instance['properties'] = json.loads(row['properties'])
+            instances.append(instance)
+        return instances
 
     def insert_or_update_instance(instance_id:str, pinned:bool, instance_type:str, properties:dict):
+        properties = dump_json(properties)
         with SQLiteConnection() as c:
-            if c.cursor.execute(
-                "SELECT id FROM instance WHERE id=?", (instance_id,)
-            ).fetchone():
-                c.cursor.execute(
-                    f"UPDATE instance SET properties=? WHERE id=?",
-                    (json.dumps(properties), instance_id)
-                )
-            else:
-                c.cursor.execute(
-                    f"INSERT INTO instance (id, pinned, type, properties) VALUES (?, ?, ?, ?)",
-                    (instance_id, 1 if pinned else 0, instance_type, json.dumps(properties))
-                )
+            # Existing instances only get their properties updated
+            c.cursor.execute(
+                "INSERT INTO instance (id, pinned, type, properties) VALUES (?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET properties=excluded.properties",
+                (instance_id, 1 if pinned else 0, instance_type, properties)
+            )
 
     def delete_instance(instance_id: str):
         with SQLiteConnection() as c:
@@ -783,40 +845,21 @@ class Instance:
         return []
 
     def append_online_instance_model_list(instance_id:str, model_name:str) -> None:
+        # The list is edited by SQLite's JSON functions, it's never parsed here
         with SQLiteConnection() as c:
-            result = c.cursor.execute(
-                "SELECT list FROM online_instance_model_list WHERE id=?",
-                (instance_id,)
-            ).fetchone()
-
-            if result:
-                model_list = json.loads(result[0])
-                model_list.append(model_name)
-                c.cursor.execute(
-                    f"UPDATE online_instance_model_list SET list=? WHERE id=?",
-                    (json.dumps(model_list), instance_id)
-                )
-            else:
-                c.cursor.execute(
-                    "INSERT INTO online_instance_model_list (id, list) VALUES (?, ?)",
-                    (instance_id, json.dumps([model_name]))
-                )
+            c.cursor.execute(
+                "INSERT INTO online_instance_model_list (id, list) VALUES (?, json_array(?)) ON CONFLICT(id) DO UPDATE SET list=json_insert(list, '$[#]', ?)",
+                (instance_id, model_name, model_name)
+            )
 
     def remove_online_instance_model_list(instance_id:str, model_name:str) -> None:
+        # Only the first match is removed, same as list.remove()
         with SQLiteConnection() as c:
-            result = c.cursor.execute(
-                "SELECT list FROM online_instance_model_list WHERE id=?",
-                (instance_id,)
-            ).fetchone()
-
-            if result:
-                model_list = json.loads(result[0])
-                if model_name in model_list:
-                    model_list.remove(model_name)
-                c.cursor.execute(
-                    f"UPDATE online_instance_model_list SET list=? WHERE id=?",
-                    (json.dumps(model_list), instance_id)
-                )
+            c.cursor.execute(
+                "UPDATE online_instance_model_list SET list=json_remove(list, (SELECT '$[' || key || ']' FROM json_each(list) WHERE value=? ORDER BY key LIMIT 1)) \
+                WHERE id=? AND EXISTS (SELECT 1 FROM json_each(list) WHERE value=?)",
+                (model_name, instance_id, model_name)
+            )
 
     ##################
     ## CHAT FOLDERS ##
@@ -853,42 +896,31 @@ class Instance:
         if folder_id is None:
             return # Can't modify root
         with SQLiteConnection() as c:
-            if c.cursor.execute(
-                "SELECT id FROM chat_folder WHERE id=?", (folder_id,)
-            ).fetchone():
-                c.cursor.execute(
-                    f"UPDATE chat_folder SET name=?, color=?, parent=? WHERE id=?",
-                    (folder_name, folder_color, parent, folder_id)
-                )
-            else:
-                c.cursor.execute(
-                    f"INSERT INTO chat_folder (id, name, color, parent) VALUES (?, ?, ?, ?)",
-                    (folder_id, folder_name, folder_color, parent)
-                )
+            c.cursor.execute(
+                "INSERT INTO chat_folder (id, name, color, parent) VALUES (?, ?, ?, ?) ON CONFLICT(id) DO UPDATE SET name=excluded.name, color=excluded.color, parent=excluded.parent",
+                (folder_id, folder_name, folder_color, parent)
+            )
 
     def remove_folder(folder_id:str):
         if folder_id is None:
             return # Can't modify root
-        result = []
+        # The folder and all of its subfolders, walked inside SQLite
+        folder_tree = "WITH RECURSIVE folder_tree(id) AS (SELECT ? UNION SELECT chat_folder.id FROM chat_folder JOIN folder_tree ON chat_folder.parent = folder_tree.id) "
         with SQLiteConnection() as c:
+            c.begin("IMMEDIATE")
             c.cursor.execute(
-                "DELETE FROM chat_folder WHERE id=?", (folder_id,)
+                folder_tree + "DELETE FROM attachment WHERE message_id IN (SELECT id FROM message WHERE chat_id IN (SELECT id FROM chat WHERE folder IN folder_tree))",
+                (folder_id,),
+            )
+            c.cursor.execute(
+                folder_tree + "DELETE FROM message WHERE chat_id IN (SELECT id FROM chat WHERE folder IN folder_tree)",
+                (folder_id,),
+            )
+            c.cursor.execute(
+                folder_tree + "DELETE FROM chat WHERE folder IN folder_tree",
+                (folder_id,),
+            )
+            c.cursor.execute(
+                folder_tree + "DELETE FROM chat_folder WHERE id IN folder_tree",
+                (folder_id,),
             )
-            result = c.cursor.execute(
-                "SELECT id FROM chat WHERE folder=?", (folder_id,)
-            ).fetchall()
-
-        for row in result:
-            class tempchat:
-                chat_id=None
-            tempchat.chat_id=row[0]
-            Instance.delete_chat(tempchat)
-
-        result = []
-        with SQLiteConnection() as c:
-            result = c.cursor.execute(
-                "SELECT id FROM chat_folder WHERE parent=?", (folder_id,)
-            ).fetchall()
-
-        for row in result:
-            Instance.remove_folder(row[0])
@@ -5,7 +5,7 @@ Handles the chat widget
 
 import gi
 from gi.repository import Gtk, Gio, Adw, Gdk, GLib
-import logging, os, datetime, random, json, threading, re, importlib.util
+import logging, os, datetime, random, json, threading, re, tempfile, importlib.util
 from ..constants import SAMPLE_PROMPTS, cache_dir
 from ..sql_manager import generate_uuid, prettify_model_name, generate_numbered_name, Instance as SQL
 from . import dialog, voice, models
@@ -115,7 +115,7 @@ class Folder(Adw.NavigationPage):
             self.list_stack.set_visible_child_name('content' if folder_visible or chat_visible else 'empty')
 
     def on_search(self, query:str):
-        if len(list(self.folder_list_box)) + len(list(self.chat_list_box)) == 0:
+        if not self.folder_list_box.get_first_child() and not self.chat_list_box.get_first_child():
             self.list_stack.set_visible_child_name('empty')
             return
 
@@ -143,14 +143,14 @@ class Folder(Adw.NavigationPage):
                     is_template=row[2]==1,
                     mode=0
                 )
-                if row[0] == selected_chat and len(list(self.chat_list_box)) > 0:
-                    self.chat_list_box.select_row(list(self.chat_list_box)[-1])
+                if row[0] == selected_chat and self.chat_list_box.get_last_child():
+                    self.chat_list_box.select_row(self.chat_list_box.get_last_child())
 
-        if len(list(self.chat_list_box)) == 0 and not self.folder_id:
+        if not self.chat_list_box.get_first_child() and not self.folder_id:
             self.chat_list_box.select_row(self.new_chat().row)
 
         if not self.chat_list_box.get_selected_row() and not self.folder_id:
-            self.chat_list_box.select_row(list(self.chat_list_box)[0])
+            self.chat_list_box.select_row(self.chat_list_box.get_first_child())
 
         folders = SQL.get_chat_folders(self.folder_id)
         for f in folders:
@@ -270,7 +270,7 @@ class Folder(Adw.NavigationPage):
             else:
                 self.get_root().global_footer.toggle_action_button(True)
 
-            if len(list(new_chat.container)) == 0:
+            if new_chat.container.get_first_child() is None:
                 new_chat.load_messages()
 
             # Show New Stack Page
@@ -281,7 +281,7 @@ class Folder(Adw.NavigationPage):
 
     def auto_select_model(self):
         def find_model_index(model_name:str) -> int:
-            if len(list(models.added.model_selector_model)) == 0 or not model_name:
+            if models.added.model_selector_model.get_n_items() == 0 or not model_name:
                 return -1
             detected_models = [i for i, future_row in enumerate(list(models.added.model_selector_model)) if future_row.model.get_name() == model_name]
             if len(detected_models) > 0:
@@ -291,8 +291,8 @@ class Folder(Adw.NavigationPage):
         chat = self.get_root().chat_bin.get_child()
         if chat:
             model_index = -1
-            if len(list(chat.container)) > 0:
-                model_index = find_model_index(list(chat.container)[-1].get_model())
+            if chat.container.get_last_child():
+                model_index = find_model_index(chat.container.get_last_child().get_model())
             if model_index == -1:
                 model_index = find_model_index(self.get_root().get_current_instance().get_default_model())
 
@@ -383,17 +383,19 @@ class Chat(Gtk.Stack):
 
     def load_messages(self):
         messages = SQL.get_messages(self)
+        attachments = SQL.get_chat_attachments(self)
+        has_messages = False
         for message in messages:
+            has_messages = True
             message_element = Message(
-                dt=datetime.datetime.strptime(message[3] + (":00" if message[3].count(":") == 1 else ""), '%Y/%m/%d %H:%M:%S'),
+                dt=datetime.datetime.fromisoformat(message[3].replace('/', '-')),
                 message_id=message[0],
                 mode=('user', 'assistant', 'system').index(message[1]),
                 author=message[2]
             )
             self.container.append(message_element)
 
-            attachments = SQL.get_attachments(message_element)
-            for attachment in attachments:
+            for attachment in attachments.get(message_element.message_id, []):
                 GLib.idle_add(
                     lambda msg=message_element, att=attachment: msg.add_attachment(
                         file_id=att[0],
@@ -403,11 +405,11 @@ class Chat(Gtk.Stack):
                     ) and False
                 )
             GLib.idle_add(message_element.block_container.set_content, message[4])
-        GLib.idle_add(self.set_visible_child_name, 'content' if len(messages) > 0 else 'welcome-screen')
+        GLib.idle_add(self.set_visible_child_name, 'content' if has_messages else 'welcome-screen')
 
     def convert_to_ollama(self) -> list:
         messages = []
-        for message in list(self.container):
+        for message in self.container:
             if message.get_content() and message.dt:
                 message_data = {
                     'role': ('user', 'assistant', 'system')[message.mode],
@@ -429,7 +431,7 @@ class Chat(Gtk.Stack):
 
     def convert_to_json(self, include_metadata:bool=False) -> list:
         messages = []
-        for message in list(self.container):
+        for message in self.container:
             if message.get_content() and message.dt:
                 message_data = {
                     'role': ('user', 'assistant', 'system')[message.mode],
@@ -479,7 +481,7 @@ class Chat(Gtk.Stack):
 
     def selected_prompt(self, prompt:str):
         if self.get_root().get_name() == 'AlpacaWindow':
-            if len(list(self.get_root().local_model_flowbox)) == 0:
+            if self.get_root().local_model_flowbox.get_first_child() is None:
                 if self.get_root().get_current_instance().instance_type == 'empty':
                     self.get_root().get_application().lookup_action('instance_manager').activate()
                 else:
@@ -655,9 +657,9 @@ class FolderRow(Gtk.ListBoxRow):
         d.show(self.get_root())
 
     def delete(self):
-        if len(list(self.get_parent())) == 1:
+        if not self.get_prev_sibling() and not self.get_next_sibling():
             self.get_parent().set_visible(False)
-            list(self.get_parent().get_parent())[1].set_visible(False)
+            self.get_parent().get_parent().get_first_child().get_next_sibling().set_visible(False)
         self.get_parent().remove(self)
         SQL.remove_folder(self.folder_id)
 
@@ -757,7 +759,7 @@ class ChatRow(Gtk.ListBoxRow):
         popup.popup()
 
     def update_profile_pictures(self):
-        for msg in list(self.chat.container):
+        for msg in self.chat.container:
             msg.update_profile_picture()
 
     def edit(self, new_name:str, is_template:bool):
@@ -807,11 +809,11 @@ class ChatRow(Gtk.ListBoxRow):
         list_box = self.get_parent()
         list_box.remove(self)
         SQL.delete_chat(self.chat)
-        if len(list(list_box)) == 0:
+        if not list_box.get_first_child():
             chat_list_page = window.get_chat_list_page()
             if chat_list_page.folder_id:
                 previous_page = window.chat_list_navigationview.get_previous_page(chat_list_page)
-                previous_page.chat_list_box.select_row(list(previous_page.chat_list_box)[0])
+                previous_page.chat_list_box.select_row(previous_page.chat_list_box.get_first_child())
                 previous_page.update_visibility()
             else:
                 chat_list_page.new_chat()
@@ -842,73 +844,92 @@ class ChatRow(Gtk.ListBoxRow):
         )
         SQL.duplicate_chat(self.chat.chat_id, new_chat)
 
-    def on_export_successful(self, file, result):
-        file.replace_contents_finish(result)
-        dialog.show_toast(_("Chat exported successfully"), self.get_root())
-
-    def on_export_chat(self, file_dialog, result, temp_path):
-        file = file_dialog.save_finish(result)
+    def copy_export(self, temp_path:str, file, root, remove_temp:bool=False):
+        # Gio copies local files in-kernel (copy_file_range / splice)
+        try:
+            Gio.File.new_for_path(temp_path).copy(file, Gio.FileCopyFlags.OVERWRITE, None, None)
+        except Exception as e:
+            logger.error(e)
+            GLib.idle_add(dialog.show_toast, _("Chat could not be exported"), root)
+            return
+        finally:
+            if remove_temp:
+                os.remove(temp_path)
+        GLib.idle_add(dialog.show_toast, _("Chat exported successfully"), root)
+
+    def on_export_chat(self, file_dialog, result, temp_path, remove_temp:bool=False):
+        try:
+            file = file_dialog.save_finish(result)
+        except GLib.Error: # Dialog was dismissed
+            file = None
         if file:
-            with open(temp_path, "rb") as db:
-                file.replace_contents_async(
-                    db.read(),
-                    etag=None,
-                    make_backup=False,
-                    flags=Gio.FileCreateFlags.NONE,
-                    cancellable=None,
-                    callback=self.on_export_successful
-                )
+            threading.Thread(target=self.copy_export, args=(temp_path, file, self.get_root(), remove_temp), daemon=True).start()
+        elif remove_temp:
+            os.remove(temp_path)
 
     def export_md(self, obsidian:bool):
         logger.info("Exporting chat (MD)")
-        markdown = []
-        for message_element in list(self.chat.container):
-            if message_element.get_content() and message_element.dt:
-                message_author = _('User')
-                if message_element.get_model():
-                    message_author = prettify_model_name(message_element.get_model())
-                if message_element.mode == 2:
-                    message_author = _('System')
-
-                markdown.append('### **{}** | {}'.format(message_author, message_element.dt.strftime("%Y/%m/%d %H:%M:%S")))
-                markdown.append(message_element.get_content())
-                for file in message_element.image_attachment_container.get_content():
-                    markdown.append('![🖼️ {}](data:image/{};base64,{})'.format(file.get('name'), file.get('name').split('.')[1], file.get('content')))
-                emojis = {
-                    'plain_text': '📃',
-                    'code': '💻',
-                    'pdf': '📕',
-                    'youtube': '📹',
-                    'website': '🌐',
-                    'thought': '🧠'
-                }
-                for file in message_element.attachment_container.get_content():
-                    if obsidian:
-                        file_block = "> [!quote]- {}\n".format(file.get('name'))
-                        for line in file.get('content').split("\n"):
-                            file_block += "> {}\n".format(line)
-                        markdown.append(file_block)
-                    else:
-                        markdown.append('<details>\n\n<summary>{} {}</summary>\n\n```TXT\n{}\n```\n\n</details>'.format(emojis.get(file.get('type'), '📃'), file.get('name'), file.get('content')))
-                markdown.append('----')
-        markdown.append('Generated from [Alpaca](https://github.com/Jeffser/Alpaca)')
+        emojis = {
+            'plain_text': '📃',
+            'code': '💻',
+            'pdf': '📕',
+            'youtube': '📹',
+            'website': '🌐',
+            'thought': '🧠'
+        }
         with open(os.path.join(cache_dir, 'export.md'), 'w') as f:
-            f.write('\n\n'.join(markdown))
+            for message_element in self.chat.container:
+                if message_element.get_content() and message_element.dt:
+                    message_author = _('User')
+                    if message_element.get_model():
+                        message_author = prettify_model_name(message_element.get_model())
+                    if message_element.mode == 2:
+                        message_author = _('System')
+
+                    f.write('### **{}** | {}\n\n'.format(message_author, message_element.dt.strftime("%Y/%m/%d %H:%M:%S")))
+                    f.write(message_element.get_content())
+                    f.write('\n\n')
+                    for file in message_element.image_attachment_container.get_content():
+                        f.write('![🖼️ {}](data:image/{};base64,{})\n\n'.format(file.get('name'), file.get('name').split('.')[1], file.get('content')))
+                    for file in message_element.attachment_container.get_content():
+                        if obsidian:
+                            f.write("> [!quote]- {}\n".format(file.get('name')))
+                            for line in file.get('content').split("\n"):
+                                f.write("> {}\n".format(line))
+                            f.write('\n\n')
+                        else:
+                            f.write('<details>\n\n<summary>{} {}</summary>\n\n```TXT\n{}\n```\n\n</details>\n\n'.format(emojis.get(file.get('type'), '📃'), file.get('name'), file.get('content')))
+                    f.write('----\n\n')
+            f.write('Generated from [Alpaca](https://github.com/Jeffser/Alpaca)')
         file_dialog = Gtk.FileDialog(initial_name=f"{self.get_name()}.md")
         file_dialog.save(parent=self.get_root(), cancellable=None, callback=lambda file_dialog, result, temp_path=os.path.join(cache_dir, 'export.md'): self.on_export_chat(file_dialog, result, temp_path))
 
     def export_db(self):
         logger.info("Exporting chat (DB)")
-        if os.path.isfile(os.path.join(cache_dir, 'export.db')):
-            os.remove(os.path.join(cache_dir, 'export.db'))
-        SQL.export_db(self.chat, os.path.join(cache_dir, 'export.db'))
-        file_dialog = Gtk.FileDialog(initial_name=f"{self.get_name()}.db")
-        file_dialog.save(parent=self.get_root(), cancellable=None, callback=lambda file_dialog, result, temp_path=os.path.join(cache_dir, 'export.db'): self.on_export_chat(file_dialog, result, temp_path))
+
+        def run_export(root):
+            # Every export gets its own file, an earlier one might still be copying
+            fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.db')
+            os.close(fd)
+            try:
+                SQL.export_db(self.chat, temp_path)
+            except Exception as e:
+                logger.error(e)
+                os.remove(temp_path)
+                GLib.idle_add(dialog.show_toast, _("Chat could not be exported"), root)
+                return
+            GLib.idle_add(show_dialog, temp_path)
+
+        def show_dialog(temp_path:str):
+            file_dialog = Gtk.FileDialog(initial_name=f"{self.get_name()}.db")
+            file_dialog.save(parent=self.get_root(), cancellable=None, callback=lambda file_dialog, result, temp_path=temp_path: self.on_export_chat(file_dialog, result, temp_path, True))
+
+        threading.Thread(target=run_export, args=(self.get_root(),), daemon=True).start()
 
     def export_json(self, include_metadata:bool):
         logger.info("Exporting chat (JSON)")
         with open(os.path.join(cache_dir, 'export.json'), 'w') as f:
-            f.write(json.dumps({self.get_name() if include_metadata else 'messages': self.chat.convert_to_json(include_metadata)}, indent=4))
+            json.dump({self.get_name() if include_metadata else 'messages': self.chat.convert_to_json(include_metadata)}, f, indent=4)
         file_dialog = Gtk.FileDialog(initial_name=f"{self.get_name()}.json")
         file_dialog.save(parent=self.get_root(), cancellable=None, callback=lambda file_dialog, result, temp_path=os.path.join(cache_dir, 'export.json'): self.on_export_chat(file_dialog, result, temp_path))
 
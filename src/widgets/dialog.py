@@ -90,15 +90,16 @@ class Entry(Base):
             self.container.append(entry)
 
         default_action = [name for name, value in options.items() if value.get('default', False)]
-        for i, entry in enumerate(list(self.container)):
-            if i < len(list(self.container)) - 1:
-                entry.connect('activate', lambda *_, index=i: list(self.container)[index+1].grab_focus())
+        for entry in self.container:
+            next_entry = entry.get_next_sibling()
+            if next_entry:
+                entry.connect('activate', lambda *_, next_entry=next_entry: next_entry.grab_focus())
             elif default_action:
                 entry.connect('activate', lambda *_, action=default_action[0]: self.response(action))
 
         self.set_extra_child(self.container)
 
-        self.connect('realize', lambda *_: list(self.container)[0].grab_focus())
+        self.connect('realize', lambda *_: self.container.get_first_child().grab_focus())
 
     def response(self, result:str):
         self.close()
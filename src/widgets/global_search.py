@@ -32,12 +32,20 @@ class GlobalSearch(Adw.Dialog):
         
         # Focus the search entry when dialog opens
         GLib.idle_add(self.search_entry.grab_focus)
+        self.connect('closed', self.on_closed)
 
     @Gtk.Template.Callback()
     def on_close(self, button=None):
         """Close the dialog"""
         self.close()
 
+    def on_closed(self, dialog):
+        """Release the search connection once the dialog is gone"""
+        if self._search_timeout_id:
+            GLib.source_remove(self._search_timeout_id)
+            self._search_timeout_id = None
+        self.search_service.close()
+
     @Gtk.Template.Callback()
     def on_search_changed(self, entry):
         """Handle search text changes with debouncing"""
@@ -247,7 +255,7 @@ class GlobalSearch(Adw.Dialog):
                 return False
             
             # Find the message widget
-            for message in list(current_chat.container):
+            for message in current_chat.container:
                 if hasattr(message, 'message_id') and message.message_id == message_id:
                     # Scroll to the message
                     message.grab_focus()
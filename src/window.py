@@ -275,14 +275,14 @@ class AlpacaWindow(Adw.ApplicationWindow):
             current_chat = self.chat_bin.get_child()
         if current_chat:
             try:
-                for message in list(current_chat.container):
+                for message in current_chat.container:
                     if message:
                         content = message.get_content()
                         if content:
                             string_search = re.search(search_term, content, re.IGNORECASE)
                             message.set_visible(string_search)
                             message_results += 1 if string_search else 0
-                            for block in list(message.block_container):
+                            for block in message.block_container:
                                 if isinstance(block, Widgets.blocks.text.Text):
                                     if search_term:
                                         content = block.get_content().replace('&', '&amp;')